@@ -52,12 +52,18 @@ class Embedding(torch.nn.Module):
 
         Return:
             Word embeddings (tensor of size n,output_dims)
+
+        A padded batch of sequences (tensor of size b,n) works too.
         """
 
         if not (isinstance(inp, int) or inp.dtype in [torch.int32, torch.int64]):
             raise TypeError('input should be an integer or tensor of integers')
         
-        emb = self.W[inp]
+        if isinstance(inp, int):
+            emb = self.W[inp]
+        else:
+            # One lookup for a whole sentence or a padded batch of sentences
+            emb = torch.nn.functional.embedding(inp, self.W)
         
         # Scaling the embedding to have norm 1 helps against overfitting.
         # https://www.aclweb.org/anthology/N18-1031/
@@ -234,7 +240,7 @@ class SoftmaxLayer(torch.nn.Module):
         self.W = torch.nn.Parameter(torch.empty(output_dims, input_dims))
         torch.nn.init.normal_(self.W, std=0.01)
 
-    def forward(self, inp):
+    def forward(self, inp, out=None):
         """Works on either single vectors or sequences of vectors.
 
         Argument:
@@ -250,6 +256,34 @@ class SoftmaxLayer(torch.nn.Module):
 
         Return:
             Vectors of log-probabilities (tensor of size n,output_dims)
+
+        If out is given, the log-probabilities are written into it
+        instead of a new tensor. This only works with autograd off.
+        """
+
+        if out is None:
+            return torch.log_softmax(self.logits(inp), dim=-1)
+        scores = self.logits(inp, out=out)
+        scores -= torch.logsumexp(scores, dim=-1, keepdim=True)
+        return scores
+
+    def logits(self, inp, idx=None, out=None):
+        """Compute the scores that forward() normalizes with a softmax.
+
+        Arguments:
+            inp: Input vector(s) (tensor of size input_dims or n,input_dims)
+            idx: If given, only compute the scores of these outputs
+                 (int, or slice or tensor of ints of size k)
+
+        Return:
+            Scores (tensor of size output_dims or n,output_dims).
+            If idx is an int, the last axis is dropped; if idx is a
+            tensor, the last axis has size k instead of output_dims.
+
+        For a batch, inp can also have size b,n,input_dims and idx can
+        have size b,k, giving scores of size b,n,k.
+
+        If out is given, the scores are written into it (see forward()).
         """
 
         input_dims = self.W.size()[-1]
@@ -259,10 +293,132 @@ class SoftmaxLayer(torch.nn.Module):
         # Scaling both the output embeddings and the inputs
         # to have norm 1 and 10, respectively, helps against overfitting.
         # https://www.aclweb.org/anthology/N18-1031/
-        W = torch.nn.functional.normalize(self.W, dim=1)
         inp = torch.nn.functional.normalize(inp, dim=-1) * 10
+        if idx is None and getattr(self, 'quantized', None) is not None:
+            scores = self.quantized(inp)
+            return scores if out is None else out.copy_(scores)
+        W = self.W if idx is None else self.W[idx]
+        W = torch.nn.functional.normalize(W, dim=-1)
+
+        if W.ndim == 1:
+            return torch.matmul(inp, W, out=out)
+        # Same as bmv(W, inp), but a sequence of sequences of vectors
+        # gets folded into one matrix multiply instead of copying W
+        return torch.matmul(inp, W.transpose(-2, -1), out=out)
+
+    def quantize(self):
+        """Quantize the weights to 8-bit integers, which makes forward()
+        faster on CPUs. Only use this after training: the quantized
+        weights don't get updated, and only the CPU can run them.
+
+        Scoring only some outputs (logits() with idx) still uses the
+        original weights."""
+
+        W = torch.nn.functional.normalize(self.W.detach(), dim=1)
+        linear = torch.nn.Linear(W.size()[1], W.size()[0], bias=False)
+        with torch.no_grad():
+            linear.weight.copy_(W)
+        # quantize_dynamic replaces submodules, so wrap linear in a Sequential.
+        # The rows of W all have norm 1 but differ in their largest
+        # entries, so give each output its own scale (per-channel).
+        self.quantized = torch.ao.quantization.quantize_dynamic(
+            torch.nn.Sequential(linear),
+            {torch.nn.Linear: torch.ao.quantization.per_channel_dynamic_qconfig},
+            dtype=torch.qint8)
+
+    def logprob_of(self, inp, idx):
+        """Compute the log-probabilities of only some outputs.
+
+        This is the same as forward(inp)[...,idx], but without
+        building the normalized output vectors.
+
+        Arguments:
+            inp: Input vector(s) (see logits())
+            idx: Outputs to compute (see logits())
+
+        Return:
+            Log-probabilities (same size as logits(inp, idx))
+        """
+
+        lse = self.logsumexp(inp)
+        if not isinstance(idx, int):
+            lse = lse.unsqueeze(-1)
+        return self.logits(inp, idx) - lse
+
+    def sampled_logprob_of(self, inp, idx, num_samples):
+        """Compute a sampled-softmax approximation of logprob_of(inp, idx).
+
+        Instead of normalizing over all outputs, normalize over just
+        idx and num_samples other outputs, chosen uniformly at random
+        (the same ones for all inputs). Samples that happen to be the
+        output in idx are left out, so it isn't counted twice. This is
+        only meant for training, where it makes the cost proportional
+        to num_samples instead of output_dims.
+
+        Because the normalizer only includes a small part of the
+        outputs, it is smaller than the true one, by roughly
+        log(output_dims/num_samples). So the results are systematically
+        too high, not just noisy, and shouldn't be read as actual
+        log-probabilities.
+
+        Arguments:
+            inp:         Input vector(s) (see logits())
+            idx:         Outputs to compute (int or tensor of ints, see logits())
+            num_samples: Number of outputs to sample (int)
+
+        Return:
+            Approximate log-probabilities (same size as logits(inp, idx))
+        """
+
+        output_dims = self.W.size()[0]
+        samples = torch.randint(output_dims, (num_samples,), device=self.W.device)
+        scores = self.logits(inp, idx)
+
+        # As in logsumexp(), the scores are between -10 and 10, so
+        # we can work with their exps directly.
+        score_exps = torch.exp(scores)
+        sample_exps = torch.exp(self.logits(inp, samples)).sum(dim=-1)
+        
+        # Count how many samples are the same as the output in idx.
+        # Such a sample's score is the same as the output's score.
+        if isinstance(idx, int):
+            hits = (samples == idx).sum()
+        else:
+            hits = (idx.unsqueeze(-1) == samples).sum(dim=-1).unsqueeze(-2)
+            sample_exps = sample_exps.unsqueeze(-1)
+        other_exps = (sample_exps - hits * score_exps).clamp(min=0.)
+
+        return scores - torch.log(score_exps + other_exps)
+
+    def logsumexp(self, inp, block_size=None):
+        """Compute the log-normalizers of forward(), that is, the
+        logsumexp of logits(inp) over all outputs.
+
+        Arguments:
+            inp:        Input vector(s) (tensor of size input_dims or n,input_dims)
+            block_size: If given, compute the scores of only this many
+                        outputs at a time (int)
+
+        Return:
+            Log-normalizers (scalar or tensor of size n)
+
+        With block_size, the full n,output_dims matrix of scores is
+        never built at once. This saves memory when autograd is off;
+        when it is on, every block is kept for the backward pass anyway.
+        """
 
-        return torch.log_softmax(bmv(W, inp), dim=-1)
+        if block_size is None:
+            return torch.logsumexp(self.logits(inp), dim=-1)
+
+        # Because both W and inp are normalized, the scores are
+        # between -10 and 10, so we can sum their exps directly
+        # without keeping track of a running maximum.
+        output_dims = self.W.size()[0]
+        total = 0.
+        for start in range(0, output_dims, block_size):
+            block = slice(start, start+block_size)
+            total = total + torch.exp(self.logits(inp, block)).sum(dim=-1)
+        return torch.log(total)
 
 def attention(query, keys, vals):
     """Compute dot-product attention.